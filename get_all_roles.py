@@ -1,8 +1,54 @@
 import json
-import requests
+from concurrent.futures import ThreadPoolExecutor
+
+import requests_cache
+import soupsieve
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 
 
+# Identify ourselves to the wiki rather than using the default python-requests agent.
+USER_AGENT = "blood-on-the-clock-tower-scad-generator"
+# Seconds to wait on the wiki before giving up on a request.
+REQUEST_TIMEOUT = 30
+# Responses are cached on disk so reruns don't hit the wiki again.
+HTTP_CACHE_NAME = "botc_http_cache"
+# Seconds before a cached response is fetched from the wiki again (one day).
+HTTP_CACHE_EXPIRE_AFTER = 86400
+# Role images are kept in the pngs directory already, so they skip the cache and
+# are streamed straight to disk rather than read into memory to be cached.
+HTTP_CACHE_URLS_EXPIRE_AFTER = {"*.png": requests_cache.DO_NOT_CACHE}
+# Number of requests to have in flight to the wiki at once.
+MAX_DOWNLOAD_WORKERS = 8
+
+# CSS selectors compiled once rather than on every select call.
+# Each role is contained in a div with specific classes.
+CONTAINER_SELECTOR = soupsieve.compile("div.small-6.medium-6.large-2.columns")
+# The span that holds the role name (using the data-role attribute).
+ROLE_SPAN_SELECTOR = soupsieve.compile("span[data-role]")
+# The image tag that shows the role's thumbnail.
+IMAGE_SELECTOR = soupsieve.compile("img.thumbimage")
+
+
+def create_session():
+    """
+    Creates a requests session for talking to the wiki.
+
+    Reusing one session keeps the connection to the wiki alive between requests,
+    so only the first request pays for the TCP and TLS handshake. Responses are
+    stored in a SQLite cache so repeated runs are served from disk, apart from the
+    role images.
+    """
+    session = requests_cache.CachedSession(
+        HTTP_CACHE_NAME,
+        expire_after=HTTP_CACHE_EXPIRE_AFTER,
+        urls_expire_after=HTTP_CACHE_URLS_EXPIRE_AFTER,
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20))
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
 def get_color_from_style(style):
     """
     Given a style string, return a color name.
@@ -47,22 +93,31 @@ def main():
     # Dictionary to hold role data.
     # Each key is a role name and its value is a dict with the image URL and color.
     role_dictionary = {}
+    session = create_session()
+
+    # Fetch all the pages at once, the time is spent waiting on the wiki.
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        futures = {
+            url: executor.submit(session.get, url, timeout=REQUEST_TIMEOUT)
+            for url in urls_to_parse
+        }
+        responses = {url: future.result() for url, future in futures.items()}
+
     # Process each URL in the urls_to_parse list.
     for url in urls_to_parse:
-        # Fetch the page content.
-        response = requests.get(url)
+        response = responses[url]
         if response.status_code != 200:
             raise Exception(f"Failed to load page {url}")
 
-        # Parse the HTML content using BeautifulSoup.
-        soup = BeautifulSoup(response.text, "html.parser")
+        # Parse the HTML content using BeautifulSoup with the C backed lxml parser.
+        soup = BeautifulSoup(response.content, "lxml")
 
         # Each role is contained in a div with specific classes.
-        for container in soup.select("div.small-6.medium-6.large-2.columns"):
+        for container in CONTAINER_SELECTOR.select(soup):
             # Look for a span that holds the role name (using the data-role attribute).
-            role_span = container.select_one("span[data-role]")
+            role_span = ROLE_SPAN_SELECTOR.select_one(container)
             # Look for the image tag that shows the role's thumbnail.
-            image_tag = container.select_one("img.thumbimage")
+            image_tag = IMAGE_SELECTOR.select_one(container)
 
             # If both the role name and image are found, process them.
             if role_span and image_tag:
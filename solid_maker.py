@@ -1,15 +1,22 @@
+import io
 import os
 import json
+import hashlib
+import functools
+import itertools
 import shutil
 import subprocess
 import textwrap
-import math
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 
-import requests
+import numpy as np
 from solid import *
 from solid.utils import *
 from solid import scad_render_to_file
-from PIL import Image, ImageOps, ImageFont
+from PIL import Image, ImageFont
+
+from get_all_roles import MAX_DOWNLOAD_WORKERS, REQUEST_TIMEOUT, create_session
 
 
 # Dimensional constants in mm
@@ -18,7 +25,97 @@ COIN_HEIGHT = 2
 LOGO_EXTRUDE_DEPTH = 0.6
 ROLE_EXTRUDE_DEPTH = 0.2
 FONT = "Dumbledor 1 Fixed"
+FONT_FILE = "assets/Dumbledor1_fixed.ttf"
 TEXT_SIZE = 4
+# Font size used to measure character widths, note that 5x the text size was found
+# to be a good function for translating pixels of text into angle distance through
+# trial and error.
+TEXT_WIDTH_FONT_SIZE = TEXT_SIZE * 5
+
+# Greyscale pixels darker than this are part of the traced role image.
+BLACK_THRESHOLD = 128
+# Longest edge in pixels of the bitmap given to Potrace. Larger images only add
+# svg vertices that make OpenSCAD's boolean operations slower.
+TRACE_MAX_DIMENSION = 256
+
+# Header written at the top of every generated scad file.
+SCAD_FILE_HEADER = "$fn=100;"
+# OpenSCAD module the role name is rendered with, written into each overlay scad.
+CURVED_TEXT_MODULE = """
+module curved_text(chars, xs, ys, angles, z, depth, font, size) {
+    for (i = [0:len(chars) - 1])
+        translate([xs[i], ys[i], z])
+            rotate(a = angles[i], v = [0, 0, 1])
+                linear_extrude(height = depth)
+                    text(chars[i], font = font, size = size,
+                         halign = "center", valign = "bottom");
+}
+"""
+
+# Bytes of a role image to write to disk at a time while downloading.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Extra OpenSCAD options used when exporting STLs. The Manifold backend does the
+# boolean operations on every coin an order of magnitude faster than CGAL, it
+# needs an OpenSCAD development snapshot from 2024 or newer.
+OPENSCAD_OPTIONS = ["--backend=manifold"]
+# Number of roles to process at once, OpenSCAD and Potrace are single threaded.
+MAX_RENDER_WORKERS = os.cpu_count()
+# The models and the image processing are defined in this file, so editing it
+# invalidates every generated greyscale png, svg and scad.
+MODEL_SOURCE = os.path.abspath(__file__)
+
+
+@dataclass(frozen=True)
+class RoleFiles:
+    """
+    The paths of every file the pipeline reads or writes for a single role.
+    """
+
+    png: str
+    grey_png: str
+    svg: str
+    overlay_scad: str
+    overlay_stl: str
+
+    @classmethod
+    def from_role(cls, role, color):
+        """
+        Builds the file paths for a role, using a filesystem safe role name.
+        """
+        role_safe = role.replace(" ", "_").replace("'", "")
+        return cls(
+            png=os.path.join("pngs", f"{role_safe}.png"),
+            grey_png=os.path.join("grey_pngs", f"{role_safe}.png"),
+            svg=os.path.join("svgs", f"{role_safe}.svg"),
+            overlay_scad=os.path.join("scads", f"{role_safe}_coin_overlay.scad"),
+            overlay_stl=os.path.join("stls", f"{color}_{role_safe}_coin_overlay.stl"),
+        )
+
+
+def needs_rebuild(outputs, inputs):
+    """
+    Make style up to date check for a build step.
+
+    Args:
+        outputs (list): Paths of the files the step produces.
+        inputs (list): Paths of the files the step reads.
+
+    Returns:
+        bool: True if any output is missing or older than any input.
+    """
+    if not all(os.path.exists(output) for output in outputs):
+        return True
+    oldest_output = min(os.path.getmtime(output) for output in outputs)
+    return any(os.path.getmtime(path) > oldest_output for path in inputs)
+
+
+@functools.lru_cache(maxsize=8)
+def load_font(font_path, font_size):
+    """
+    Loads a font with Pillow, parsing each font file and size only once.
+    """
+    return ImageFont.truetype(font_path, font_size)
 
 
 def get_relative_widths_pillow(font_path, font_size, characters):
@@ -35,7 +132,7 @@ def get_relative_widths_pillow(font_path, font_size, characters):
         dict: A dictionary where keys are characters and values are their widths.
     """
     try:
-        font = ImageFont.truetype(font_path, font_size)
+        font = load_font(font_path, font_size)
     except IOError:
         print(f"Error: Font file not found at {font_path}")
         return {}
@@ -48,6 +145,31 @@ def get_relative_widths_pillow(font_path, font_size, characters):
     return widths
 
 
+def link_into_scads(filename):
+    """
+    Makes 'filename' available in the scads directory so openscad can use it.
+
+    The file is hard linked where possible so nothing is copied, falling back to a
+    copy when linking isn't supported. Nothing is done when the scads directory
+    already has an up to date version of the file.
+
+    Returns:
+        str: The path of the file in the scads directory.
+    """
+    destination = os.path.join("scads", os.path.basename(filename))
+    if os.path.exists(destination):
+        if os.path.samefile(filename, destination) or not needs_rebuild(
+            [destination], [filename]
+        ):
+            return destination
+        os.remove(destination)
+    try:
+        os.link(filename, destination)
+    except OSError:
+        shutil.copy(filename, destination)
+    return destination
+
+
 def felt_coin_model():
     """
     Creates the base coin model with the botc logo cut into the base
@@ -56,16 +178,46 @@ def felt_coin_model():
     return cylinder(d=COIN_DIAMETER, h=COIN_HEIGHT)
 
 
+def curved_text(chars, xs, ys, angles):
+    """
+    Calls the curved_text module from CURVED_TEXT_MODULE, which extrudes each
+    character at its position on the coin with a single OpenSCAD for loop
+    instead of a separate tree of nodes per character.
+
+    Args:
+        chars (str): The characters to render, in order.
+        xs (list): The x position of each character.
+        ys (list): The y position of each character.
+        angles (list): The rotation in degrees of each character.
+    """
+    return OpenSCADObject(
+        "curved_text",
+        {
+            "chars": chars,
+            "xs": xs,
+            "ys": ys,
+            "angles": angles,
+            "z": COIN_HEIGHT - ROLE_EXTRUDE_DEPTH,
+            "depth": ROLE_EXTRUDE_DEPTH,
+            "font": FONT,
+            "size": TEXT_SIZE,
+        },
+    )
+
+
 def role_overlay_model(
     role_name,
     svg_filename,
+    relative_widths=None,
 ):
     """
     Creates a colored overlay model add to the coin with the role name and image.
+    Pass the character widths measured for every role up front as
+    'relative_widths' to avoid measuring this role's characters again.
     """
-    # Copy the svg into the scads directory so openscad can use it
-    shutil.copy(svg_filename, "scads")
-    print(f"Copied {svg_filename} to scads directory for use in OpenSCAD.")
+    # Put the svg into the scads directory so openscad can use it
+    link_into_scads(svg_filename)
+    print(f"Linked {svg_filename} to scads directory for use in OpenSCAD.")
 
     # Import the SVG file as a 2D shape.
     svg_shape = import_(os.path.basename(svg_filename), convexity=10)
@@ -81,118 +233,139 @@ def role_overlay_model(
     extruded_svg = translate((0, 0, COIN_HEIGHT - ROLE_EXTRUDE_DEPTH))(extruded_svg)
 
     # --- Curved Text ---
-    # Calculate the width of characters, note that 5x the text size was found to be
-    # a good function for translating pixels of text into angle distance through
-    # trial and error.
+    # Calculate the width of characters
     printed_role_name = role_name.upper()
-    font_file = "assets/Dumbledor1_fixed.ttf"
-    relative_widths = get_relative_widths_pillow(
-        font_file, TEXT_SIZE * 5, printed_role_name
-    )
-    # Set the width of space to be 14
-    relative_widths[' '] = 14
+    if relative_widths is None:
+        relative_widths = get_relative_widths_pillow(
+            FONT_FILE, TEXT_WIDTH_FONT_SIZE, printed_role_name
+        )
+    # Set the width of space to be 14, without changing the shared widths
+    relative_widths = {**relative_widths, " ": 14}
 
     radius = COIN_DIAMETER / 2 - 2  # Adjust radius to bring text closer to the edge
     text_angle = 270  # Start at the bottom
 
+    widths = np.array([relative_widths[c] for c in printed_role_name], dtype=float)
+
     # calculate the total angle so we know where to start rendering characters
-    average_char_width = sum([relative_widths[c] for c in printed_role_name]) / len(
-        role_name
-    )
+    average_char_width = widths.sum() / len(role_name)
 
     total_angle = (len(role_name) - 1) * average_char_width
     start_angle = text_angle - total_angle / 2
 
-    text_parts = []
-    char_angle = start_angle
-    previons_width = 0
-    for i, char in enumerate(printed_role_name):
-        # Advance the position of the character except in the case of the first
-        # character where our previous width was 0.
-        # We do this by averaging the width of this character and the one before it
-        # as the angle where we render the character can be thought of the point
-        # along the curve it is rendered in the center bottom edge of the character.
-        if previons_width != 0:
-            char_angle += sum([previons_width, relative_widths[char]]) / 2.0
-
-        x = radius * math.cos(math.radians(char_angle))
-        y = radius * math.sin(math.radians(char_angle))
-
-        # Use rotate_extrude for 3D text and rotate each character so its top points outward
-        character = text(
-            char,
-            font=FONT,
-            size=TEXT_SIZE,
-            halign="center",
-            valign="bottom",
-        )
-        char_3d = linear_extrude(height=ROLE_EXTRUDE_DEPTH)(character)
-        rotated_char = translate((x, y, COIN_HEIGHT - ROLE_EXTRUDE_DEPTH))(
-            rotate(a=char_angle + 90, v=[0, 0, 1])(char_3d)
-        )  # add 90 to the rotation
-        text_parts.append(rotated_char)
-        previons_width = relative_widths[char]
+    # Work out the angle of every character up front so the positions can be
+    # computed in one vectorized pass.
+    # Each character advances from the one before it by the average of their
+    # widths, as the angle where we render the character can be thought of the
+    # point along the curve it is rendered in the center bottom edge of the
+    # character. A character after a zero width one doesn't advance.
+    advances = np.where(widths[:-1] != 0, (widths[:-1] + widths[1:]) / 2.0, 0.0)
+    char_angles = start_angle + np.concatenate(([0.0], advances)).cumsum()
+
+    char_radians = np.radians(char_angles)
+    xs = (radius * np.cos(char_radians)).tolist()
+    ys = (radius * np.sin(char_radians)).tolist()
 
-    curved_text = union()(*text_parts)
+    # Rotate each character so its top points outward, add 90 to the rotation
+    role_text = curved_text(printed_role_name, xs, ys, (char_angles + 90).tolist())
 
     # Combine the extruded svg and text for the overlay.
-    return extruded_svg + curved_text
+    return extruded_svg + role_text
 
 
-def download_png(url, filename):
+def download_png(url, filename, session=None):
     """
     Downloads a PNG image from the provided URL and saves it to 'filename'.
+    Pass a shared session to reuse its connection across many downloads.
+    The image is streamed to disk in chunks rather than held in memory, into a
+    temporary file that only replaces 'filename' once the download completes.
     """
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        print(f"Downloaded {filename}")
-    else:
-        raise Exception(f"Failed to download {url}")
-
-
-def convert_png_to_greyscale_png(png_path, greyscale_png_path):
+    if session is None:
+        session = create_session()
+    partial_filename = f"{os.fspath(filename)}.part"
+    try:
+        with session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as r:
+            r.raise_for_status()
+            with open(partial_filename, "wb") as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        os.replace(partial_filename, filename)
+    except BaseException:
+        # Don't leave a truncated image behind to be mistaken for a download.
+        if os.path.exists(partial_filename):
+            os.remove(partial_filename)
+        raise
+    print(f"Downloaded {filename}")
+
+
+def load_flattened_grey(png_path):
     """
-    Converts a PNG image to a greyscale version.
-    The conversion composites the PNG on a white background (removing transparency)
-    and then converts it to greyscale before saving.
+    Opens a PNG image and flattens it into greyscale.
+    The PNG is composited on a white background (removing transparency)
+    and then converted to greyscale.
     """
     img = Image.open(png_path).convert("RGBA")
     background = Image.new("RGBA", img.size, (255, 255, 255))
     composite = Image.alpha_composite(background, img)
-    greyscale_img = composite.convert("L")
+    return composite.convert("L")
+
+
+def convert_png_to_greyscale_png(png_path, greyscale_png_path):
+    """
+    Converts a PNG image to a greyscale version and saves it.
+    Returns the greyscale image so later steps don't need to decode it again.
+    """
+    greyscale_img = load_flattened_grey(png_path)
     greyscale_img.save(greyscale_png_path)
     print(f"Converted {png_path} to {greyscale_png_path}")
+    return greyscale_img
 
 
-def convert_to_svg_with_potrace(png_path, svg_path):
+def threshold_greyscale(png_path, img=None):
     """
-    Converts a PNG image to an svg file using ImageMagick and Potrace.
-    Requires ImageMagick and Potrace to be installed and in the system's PATH.
+    Thresholds a greyscale image into a bitmap for tracing.
+    Images larger than TRACE_MAX_DIMENSION are downsampled first, keeping their
+    aspect ratio.
+    Pass the already decoded image as 'img' to avoid reading 'png_path' again.
+
+    Returns:
+        numpy.ndarray: 2D boolean array, True where the image is dark.
+    """
+    if img is None:
+        img = Image.open(png_path).convert("L")
+    if max(img.size) > TRACE_MAX_DIMENSION:
+        scale = TRACE_MAX_DIMENSION / max(img.size)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS)
+    return np.asarray(img) < BLACK_THRESHOLD
+
+
+def convert_to_svg_with_potrace(png_path, svg_path, img=None):
+    """
+    Converts a greyscale PNG image to an svg file using Potrace.
+    Requires Potrace to be installed and in the system's PATH.
+    Pass the already decoded greyscale image as 'img' to avoid reading it again.
     """
     try:
-        # 1. Convert PNG to PBM (Portable Bitmap) using ImageMagick
-        pbm_path = png_path.replace(".png", ".pbm")  # Create a .pbm filename
-        subprocess.run(
-            [
-                "convert",
-                png_path,
-                "-monochrome",
-                pbm_path,
-            ],  # "-monochrome" for black/white
-            check=True,
-            capture_output=True,
-        )
-        print(f"Converted {png_path} to {pbm_path}")
+        bitmap = threshold_greyscale(png_path, img)
+    except OSError as e:
+        # Pillow raises an OSError for missing and unreadable images alike.
+        print(f"Error reading {png_path}: {e}")
+        return
+
+    try:
+        # 1. Encode the thresholded bitmap as a PBM (Portable Bitmap) in memory,
+        # Pillow's mode "1" has the white pixels set.
+        pbm = io.BytesIO()
+        Image.fromarray(~bitmap).save(pbm, format="PPM")
 
         dimension = "{:.2f}cm".format(COIN_DIAMETER / 10)
 
-        # 2. Convert PBM to svg using Potrace
+        # 2. Pipe the PBM into Potrace on stdin to convert it to svg
         subprocess.run(
             [
                 "potrace",
-                pbm_path,
+                "-",
                 "-o",
                 svg_path,
                 "--svg",
@@ -201,23 +374,41 @@ def convert_to_svg_with_potrace(png_path, svg_path):
                 "-H",
                 dimension,
             ],
+            input=pbm.getvalue(),
             check=True,
             capture_output=True,
         )
-        print(f"Converted {pbm_path} to {svg_path} using Potrace")
+        print(f"Converted {png_path} to {svg_path} using Potrace")
 
     except subprocess.CalledProcessError as e:
         print(f"Error converting to svg: {e.stderr.decode()}")
     except FileNotFoundError as e:
         print(
-            f"Error: {e.strerror}.  Please ensure ImageMagick and Potrace are installed and in your PATH."
+            f"Error: {e.strerror}.  "
+            "Please ensure Potrace is installed and in your PATH."
         )
 
 
+def render_scad(model, scad_filename, modules=""):
+    """
+    Writes a model out as a scad file, after any OpenSCAD 'modules' it calls.
+
+    SolidPython would otherwise append the whole of this file's source code and a
+    timestamp to every scad, making each one far larger than the model itself.
+    """
+    scad_render_to_file(
+        model,
+        scad_filename,
+        file_header=SCAD_FILE_HEADER + modules,
+        include_orig_code=False,
+    )
+
+
 def export_coin_to_stl(model, scad_filename="coin.scad", stl_filename="coin.stl"):
     # Convert SCAD to STL using OpenSCAD CLI
     result = subprocess.run(
-        ["openscad", "-o", stl_filename, scad_filename], capture_output=True
+        ["openscad", *OPENSCAD_OPTIONS, "-o", stl_filename, scad_filename],
+        capture_output=True,
     )
 
     if result.returncode == 0:
@@ -225,6 +416,84 @@ def export_coin_to_stl(model, scad_filename="coin.scad", stl_filename="coin.stl"
     else:
         print("❌ Error generating STL")
         print(result.stderr.decode())
+    return result.returncode == 0
+
+
+def scad_digest(scad_filename, imports=()):
+    """
+    Returns the sha256 hex digest of a scad file's contents and the contents of
+    every file it imports, as the scad only names the files it imports.
+    """
+    digest = hashlib.sha256()
+    for filename in (scad_filename, *imports):
+        with open(filename, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def stl_is_current(scad_filename, stl_filename, imports=()):
+    """
+    Checks if an STL was exported from the current contents of its scad and the
+    files it imports.
+
+    The digest of the scad and its 'imports' is stamped next to it after each
+    export, so a scad that was rewritten with identical contents doesn't cause
+    another export. Without a stamp this falls back to comparing modification times.
+    """
+    stamp_filename = scad_filename + ".sha256"
+    if not os.path.exists(stl_filename):
+        return False
+    if not os.path.exists(stamp_filename):
+        return not needs_rebuild([stl_filename], [scad_filename, *imports])
+    with open(stamp_filename) as f:
+        return f.read().strip() == scad_digest(scad_filename, imports)
+
+
+def export_stale_coin_to_stl(model, scad_filename, stl_filename, imports=()):
+    """
+    Exports a scad to STL unless the existing STL is already current, stamping the
+    digest of the scad and the files it 'imports' after a successful export.
+    """
+    if stl_is_current(scad_filename, stl_filename, imports):
+        return
+    if export_coin_to_stl(model, scad_filename, stl_filename):
+        with open(scad_filename + ".sha256", "w") as f:
+            f.write(scad_digest(scad_filename, imports))
+
+
+def process_role(role, files, relative_widths=None):
+    """
+    Runs the whole pipeline for a single role, from the downloaded PNG to the
+    overlay STL. Each step is skipped when its output is newer than its inputs,
+    including this file which holds the code for every step.
+
+    Roles share no state, so this is run for many roles at once in separate
+    processes. 'relative_widths' are the character widths measured up front for
+    every role.
+
+    Returns:
+        RoleFiles: The files generated for the role.
+    """
+    greyscale_img = None
+    if needs_rebuild([files.grey_png], [files.png, MODEL_SOURCE]):
+        greyscale_img = convert_png_to_greyscale_png(files.png, files.grey_png)
+
+    # Convert the grayscale PNG to svg using Potrace, reusing the greyscale
+    # image when it was just made.
+    if needs_rebuild([files.svg], [files.grey_png, MODEL_SOURCE]):
+        convert_to_svg_with_potrace(files.grey_png, files.svg, img=greyscale_img)
+
+    overlay_model = None
+    if needs_rebuild([files.overlay_scad], [files.svg, MODEL_SOURCE]):
+        overlay_model = role_overlay_model(role, files.svg, relative_widths)
+        render_scad(overlay_model, files.overlay_scad, CURVED_TEXT_MODULE)
+        print(f"Generated {files.overlay_scad} for role {role} overlay")
+
+    export_stale_coin_to_stl(
+        overlay_model, files.overlay_scad, files.overlay_stl, imports=[files.svg]
+    )
+
+    return files
 
 
 def main():
@@ -237,40 +506,57 @@ def main():
     os.makedirs("scads", exist_ok=True)
     os.makedirs("stls", exist_ok=True)
 
+    session = create_session()
+
     base_model = felt_coin_model()
     base_scad_filename = os.path.join("scads", f"000_coin_base_2mm_felt.scad")
     base_stl_filename = os.path.join("stls", f"000_coin_base_2mm_felt.stl")
-    scad_render_to_file(base_model, base_scad_filename, file_header="$fn=100;")
-    export_coin_to_stl(base_model, base_scad_filename, base_stl_filename)
-    print("Generated the base coin scad and stl")
-
-    for role, data in roles.items():
-        color = data["color"]
-        role_safe = role.replace(" ", "_").replace("'", "")
-        png_filename = os.path.join("pngs", f"{role_safe}.png")
-        grey_png_filename = os.path.join("grey_pngs", f"{role_safe}.png")
-        svg_filename = os.path.join("svgs", f"{role_safe}.svg")
-        overlay_scad_filename = os.path.join("scads", f"{role_safe}_coin_overlay.scad")
-        overlay_stl_filename = os.path.join(
-            "stls", f"{color}_{role_safe}_coin_overlay.stl"
+    if needs_rebuild([base_scad_filename], [MODEL_SOURCE]):
+        render_scad(base_model, base_scad_filename)
+    print("Generated the base coin scad")
+
+    role_files = {
+        role: RoleFiles.from_role(role, data["color"]) for role, data in roles.items()
+    }
+
+    # Download all the missing role images up front, in parallel. One directory
+    # listing finds what is already downloaded rather than a stat per role.
+    existing_pngs = {entry.name for entry in os.scandir("pngs")}
+    downloads = [
+        (data["image"], role_files[role].png)
+        for role, data in roles.items()
+        if os.path.basename(role_files[role].png) not in existing_pngs
+    ]
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        # Consume the results so any download error is raised here.
+        list(
+            executor.map(
+                lambda download: download_png(*download, session=session), downloads
+            )
         )
 
-        if not os.path.exists(png_filename):
-            download_png(data["image"], png_filename)
-        convert_png_to_greyscale_png(png_filename, grey_png_filename)
-
-        # Convert the grayscale PNG to svg using ImageMagick and Potrace
-        convert_to_svg_with_potrace(grey_png_filename, svg_filename)
-
-        overlay_model = role_overlay_model(role, svg_filename)
+    # Measure every character used in any role name once, rather than per role.
+    characters = "".join(sorted(set("".join(roles).upper())))
+    relative_widths = get_relative_widths_pillow(
+        FONT_FILE, TEXT_WIDTH_FONT_SIZE, characters
+    )
 
-        scad_render_to_file(
-            overlay_model, overlay_scad_filename, file_header="$fn=100;"
+    # Every role is CPU bound and independent, so process them all in parallel
+    # alongside the base coin's STL export.
+    with ProcessPoolExecutor(max_workers=MAX_RENDER_WORKERS) as executor:
+        base_export = executor.submit(
+            export_stale_coin_to_stl, base_model, base_scad_filename, base_stl_filename
         )
-        print(f"Generated {overlay_scad_filename} for role {role} overlay")
-
-        export_coin_to_stl(overlay_model, overlay_scad_filename, overlay_stl_filename)
-        print(f"Generated {overlay_stl_filename} for role {role} overlay")
+        generated = list(
+            executor.map(
+                process_role,
+                role_files.keys(),
+                role_files.values(),
+                itertools.repeat(relative_widths),
+            )
+        )
+        base_export.result()
+    print(f"Processed {len(generated)} roles")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import io
 import os
 from unittest.mock import patch, MagicMock
 
@@ -7,12 +8,22 @@ from PIL import Image
 # Import functions from the solid_maker module
 from solid_maker import (
     convert_png_to_greyscale_png,
+    load_flattened_grey,
     get_relative_widths_pillow,
     felt_coin_model,
     role_overlay_model,
     download_png,
     convert_to_svg_with_potrace,
     export_coin_to_stl,
+    needs_rebuild,
+    link_into_scads,
+    RoleFiles,
+    render_scad,
+    threshold_greyscale,
+    export_stale_coin_to_stl,
+    process_role,
+    curved_text,
+    CURVED_TEXT_MODULE,
 )
 
 
@@ -40,6 +51,21 @@ def test_convert_png_to_greyscale_png(test_image_path, tmp_path):
     assert img.mode == "L"  # L is PIL's mode for greyscale
 
 
+def test_load_flattened_grey(tmp_path):
+    """Test that transparency is flattened onto white before greyscaling."""
+    img_path = tmp_path / "transparent.png"
+    img = Image.new("RGBA", (2, 1), color=(0, 0, 0, 0))
+    img.putpixel((1, 0), (0, 0, 0, 255))
+    img.save(img_path)
+
+    grey = load_flattened_grey(img_path)
+
+    assert grey.mode == "L"
+    # Fully transparent pixels become white, opaque black stays black
+    assert grey.getpixel((0, 0)) == 255
+    assert grey.getpixel((1, 0)) == 0
+
+
 @patch("PIL.ImageFont.truetype")
 def test_get_relative_widths_pillow(mock_truetype, tmp_path):
     """Test that relative widths calculation works correctly."""
@@ -79,50 +105,94 @@ def test_felt_coin_model():
     assert "cylinder" in str(type(model))
 
 
-@patch("solid_maker.import_")
-@patch("solid_maker.translate")
-@patch("solid_maker.linear_extrude")
-@patch("solid_maker.text")
-@patch("solid_maker.union")
 @patch("solid_maker.get_relative_widths_pillow")
-@patch("shutil.copy")
-def test_role_overlay_model(mock_copy, mock_get_widths, mock_union, mock_text,
-                            mock_extrude, mock_translate, mock_import):
+@patch("solid_maker.link_into_scads")
+def test_role_overlay_model(mock_link, mock_get_widths, tmp_path):
     """Test that the role overlay model is created correctly."""
-    # Set up mocks
     # Return a width for each character in "TEST ROLE" (uppercase)
     mock_get_widths.return_value = {
         "T": 10, "E": 10, "S": 10,
         "R": 10, "O": 10, "L": 10,
         " ": 14
     }
-    mock_union.return_value = MagicMock()
 
     # Call the function
     result = role_overlay_model("Test Role", "test.svg")
 
-    # Verify the SVG was copied
-    mock_copy.assert_called_once_with("test.svg", "scads")
+    # Verify the SVG was made available to openscad
+    mock_link.assert_called_once_with("test.svg")
+
+    # The role name is rendered with a single call to the curved_text module
+    scad_path = tmp_path / "overlay.scad"
+    render_scad(result, scad_path)
+    scad = scad_path.read_text()
+    assert scad.count("curved_text(") == 1
+    assert 'chars = "TEST ROLE"' in scad
+    assert 'file = "test.svg"' in scad
+
 
-    # We can't easily test all the details, but we can verify the function ran without errors
+@patch("solid_maker.get_relative_widths_pillow")
+@patch("solid_maker.link_into_scads")
+def test_role_overlay_model_with_shared_widths(mock_link, mock_get_widths):
+    """Test that widths measured up front are used without being modified."""
+    widths = {"I": 5, "M": 12, "P": 10}
+
+    result = role_overlay_model("Imp", "imp.svg", widths)
+
+    # The characters aren't measured again and the shared widths are untouched
+    mock_get_widths.assert_not_called()
+    assert widths == {"I": 5, "M": 12, "P": 10}
     assert result is not None
 
 
-@patch("requests.get")
-def test_download_png(mock_get, tmp_path):
+def test_curved_text(tmp_path):
+    """Test that curved text is a single call to the curved_text module."""
+    scad_path = tmp_path / "text.scad"
+    model = curved_text("AB", [1.0, 2.0], [3.0, 4.0], [90.0, 100.0])
+    render_scad(model, scad_path, CURVED_TEXT_MODULE)
+
+    scad = scad_path.read_text()
+    # The module is defined in the file and called once for every character
+    assert "module curved_text(" in scad
+    assert scad.count("curved_text(") == 2
+    assert 'chars = "AB"' in scad
+
+
+def test_link_into_scads(tmp_path, monkeypatch):
+    """Test that files are linked into the scads directory once."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("scads")
+    svg_path = tmp_path / "role.svg"
+    svg_path.write_text("<svg/>")
+
+    destination = link_into_scads(str(svg_path))
+
+    assert destination == os.path.join("scads", "role.svg")
+    assert os.path.samefile(svg_path, destination)
+
+    # Calling it again leaves the existing link in place
+    with patch("os.link") as mock_link:
+        link_into_scads(str(svg_path))
+        mock_link.assert_not_called()
+
+
+def test_download_png(tmp_path):
     """Test that PNG download works correctly."""
-    # Set up mock response
+    # Set up mock session and streamed response
+    mock_session = MagicMock()
     mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.content = b"test content"
-    mock_get.return_value = mock_response
+    mock_response.iter_content.return_value = [b"test ", b"content"]
+    mock_session.get.return_value.__enter__.return_value = mock_response
 
     # Call the function
     output_path = tmp_path / "test_download.png"
-    download_png("https://example.com/test.png", output_path)
+    download_png("https://example.com/test.png", output_path, session=mock_session)
 
-    # Verify the request was made
-    mock_get.assert_called_once_with("https://example.com/test.png")
+    # Verify the request was streamed through the shared session
+    mock_session.get.assert_called_once_with(
+        "https://example.com/test.png", stream=True, timeout=30
+    )
+    mock_response.raise_for_status.assert_called_once()
 
     # Check that the file was created
     assert os.path.exists(output_path)
@@ -132,6 +202,26 @@ def test_download_png(mock_get, tmp_path):
         assert f.read() == b"test content"
 
 
+def test_download_png_interrupted(tmp_path):
+    """Test that an interrupted download leaves no partial image behind."""
+    mock_session = MagicMock()
+    mock_response = MagicMock()
+
+    def iter_content(chunk_size):
+        yield b"partial"
+        raise ConnectionError("connection closed")
+
+    mock_response.iter_content.side_effect = iter_content
+    mock_session.get.return_value.__enter__.return_value = mock_response
+
+    output_path = tmp_path / "test_download.png"
+    with pytest.raises(ConnectionError):
+        download_png("https://example.com/test.png", output_path, session=mock_session)
+
+    assert not os.path.exists(output_path)
+    assert os.listdir(tmp_path) == []
+
+
 @patch("subprocess.run")
 @patch("solid_maker.Path")
 def test_convert_to_svg_with_potrace(mock_path, mock_run, test_image_path, tmp_path):
@@ -146,8 +236,70 @@ def test_convert_to_svg_with_potrace(mock_path, mock_run, test_image_path, tmp_p
     # Call the function with string paths instead of Path objects
     convert_to_svg_with_potrace(png_path_str, output_path_str)
 
-    # Verify subprocess.run was called twice (once for convert, once for potrace)
-    assert mock_run.call_count == 2
+    # Verify only potrace was run, the PBM is written by Pillow
+    assert mock_run.call_count == 1
+    assert mock_run.call_args[0][0][0] == "potrace"
+
+
+@patch("subprocess.run")
+def test_convert_to_svg_with_potrace_from_image(mock_run, tmp_path):
+    """Test that a decoded image is thresholded into the PBM piped to potrace."""
+    mock_run.return_value = MagicMock(returncode=0)
+
+    # A black square on a white background
+    img = Image.new("L", (10, 10), color=255)
+    img.paste(0, (2, 2, 8, 8))
+    png_path_str = str(tmp_path / "not_read.png")
+    output_path_str = str(tmp_path / "test_output.svg")
+
+    convert_to_svg_with_potrace(png_path_str, output_path_str, img=img)
+
+    # Potrace reads the PBM from stdin, with the square black and the
+    # background white
+    assert mock_run.call_count == 1
+    assert mock_run.call_args[0][0][:2] == ["potrace", "-"]
+    pbm = Image.open(io.BytesIO(mock_run.call_args[1]["input"])).convert("L")
+    assert pbm.getpixel((5, 5)) == 0
+    assert pbm.getpixel((0, 0)) == 255
+
+    # No intermediate PBM file is written
+    assert not os.path.exists(png_path_str.replace(".png", ".pbm"))
+
+
+@patch("subprocess.run")
+def test_convert_to_svg_with_potrace_unreadable_png(mock_run, tmp_path, capsys):
+    """Test that a missing or corrupt greyscale PNG is reported, not raised."""
+    corrupt_path = tmp_path / "corrupt.png"
+    corrupt_path.write_bytes(b"not a png")
+
+    for png_path in [tmp_path / "missing.png", corrupt_path]:
+        convert_to_svg_with_potrace(str(png_path), str(tmp_path / "out.svg"))
+        assert f"Error reading {png_path}" in capsys.readouterr().out
+
+    mock_run.assert_not_called()
+
+
+def test_threshold_greyscale_downsamples_large_images():
+    """Test that large images are shrunk before tracing, keeping aspect ratio."""
+    img = Image.new("L", (1024, 512), color=255)
+    img.paste(0, (0, 0, 512, 512))
+
+    bitmap = threshold_greyscale("unused.png", img)
+
+    assert bitmap.shape == (128, 256)
+    # The dark left half is filled and the white right half isn't
+    assert bitmap[64, 10] and not bitmap[64, 250]
+
+
+def test_render_scad(tmp_path):
+    """Test that scads are written with the header and without the source code."""
+    scad_path = tmp_path / "coin.scad"
+    render_scad(felt_coin_model(), scad_path)
+
+    scad = scad_path.read_text()
+    assert scad.startswith("$fn=100;")
+    assert "cylinder" in scad
+    assert "SolidPython" not in scad
 
 
 @patch("subprocess.run")
@@ -161,6 +313,139 @@ def test_export_coin_to_stl(mock_run):
 
     # Verify subprocess.run was called with the correct parameters
     mock_run.assert_called_once_with(
-        ["openscad", "-o", "test.stl", "test.scad"],
+        ["openscad", "--backend=manifold", "-o", "test.stl", "test.scad"],
         capture_output=True
     )
+
+
+def test_role_files_from_role():
+    """Test that role file paths use a filesystem safe role name."""
+    files = RoleFiles.from_role("Lil' Monsta", "red")
+
+    assert files.png == os.path.join("pngs", "Lil_Monsta.png")
+    assert files.grey_png == os.path.join("grey_pngs", "Lil_Monsta.png")
+    assert files.svg == os.path.join("svgs", "Lil_Monsta.svg")
+    assert files.overlay_scad == os.path.join("scads", "Lil_Monsta_coin_overlay.scad")
+    assert files.overlay_stl == os.path.join("stls", "red_Lil_Monsta_coin_overlay.stl")
+
+
+def test_needs_rebuild(tmp_path):
+    """Test that outputs are only rebuilt when missing or out of date."""
+    source = tmp_path / "source.png"
+    output = tmp_path / "output.png"
+    source.write_bytes(b"source")
+
+    # A missing output always needs building
+    assert needs_rebuild([output], [source])
+
+    # An output newer than its input is up to date
+    output.write_bytes(b"output")
+    os.utime(source, (1000, 1000))
+    os.utime(output, (2000, 2000))
+    assert not needs_rebuild([output], [source])
+
+    # Touching the input makes the output stale again
+    os.utime(source, (3000, 3000))
+    assert needs_rebuild([output], [source])
+
+
+@patch("solid_maker.export_coin_to_stl")
+def test_export_stale_coin_to_stl(mock_export, tmp_path):
+    """Test that STLs are only re-exported when their scad contents change."""
+    scad_path = str(tmp_path / "coin.scad")
+    stl_path = str(tmp_path / "coin.stl")
+    with open(scad_path, "w") as f:
+        f.write("cylinder(d = 45, h = 2);")
+
+    def export(model, scad_filename, stl_filename):
+        with open(stl_filename, "w") as f:
+            f.write("solid")
+        return True
+
+    mock_export.side_effect = export
+
+    # The first export stamps the scad's digest
+    export_stale_coin_to_stl(None, scad_path, stl_path)
+    assert mock_export.call_count == 1
+    assert os.path.exists(scad_path + ".sha256")
+
+    # Rewriting the scad with the same contents doesn't export again, even
+    # though it is now newer than the STL
+    with open(scad_path, "w") as f:
+        f.write("cylinder(d = 45, h = 2);")
+    os.utime(stl_path, (1000, 1000))
+    export_stale_coin_to_stl(None, scad_path, stl_path)
+    assert mock_export.call_count == 1
+
+    # Changing the scad does export again
+    with open(scad_path, "w") as f:
+        f.write("cylinder(d = 40, h = 2);")
+    export_stale_coin_to_stl(None, scad_path, stl_path)
+    assert mock_export.call_count == 2
+
+
+@patch("solid_maker.export_coin_to_stl")
+def test_export_stale_coin_to_stl_imports(mock_export, tmp_path):
+    """Test that STLs are re-exported when a file the scad imports changes."""
+    scad_path = str(tmp_path / "overlay.scad")
+    stl_path = str(tmp_path / "overlay.stl")
+    svg_path = str(tmp_path / "role.svg")
+    with open(scad_path, "w") as f:
+        f.write('import(file = "role.svg");')
+    with open(svg_path, "w") as f:
+        f.write("<svg/>")
+    mock_export.return_value = True
+
+    export_stale_coin_to_stl(None, scad_path, stl_path, imports=[svg_path])
+    with open(stl_path, "w") as f:
+        f.write("solid")
+    assert mock_export.call_count == 1
+
+    # The scad is unchanged, but the artwork it imports was traced again
+    with open(svg_path, "w") as f:
+        f.write('<svg><path d="M0,0"/></svg>')
+    export_stale_coin_to_stl(None, scad_path, stl_path, imports=[svg_path])
+    assert mock_export.call_count == 2
+
+
+@patch("solid_maker.export_stale_coin_to_stl")
+@patch("solid_maker.render_scad")
+@patch("solid_maker.role_overlay_model")
+@patch("solid_maker.convert_to_svg_with_potrace")
+@patch("solid_maker.convert_png_to_greyscale_png")
+def test_process_role_rebuilds_after_code_changes(
+    mock_grey, mock_svg, mock_model, mock_render, mock_export, tmp_path, monkeypatch
+):
+    """Test that every step reruns when the code that produces it is newer."""
+    files = RoleFiles(
+        png=str(tmp_path / "imp.png"),
+        grey_png=str(tmp_path / "grey_imp.png"),
+        svg=str(tmp_path / "imp.svg"),
+        overlay_scad=str(tmp_path / "imp.scad"),
+        overlay_stl=str(tmp_path / "imp.stl"),
+    )
+    source = tmp_path / "solid_maker.py"
+    monkeypatch.setattr("solid_maker.MODEL_SOURCE", str(source))
+    for path, mtime in [
+        (files.png, 1000),
+        (files.grey_png, 2000),
+        (files.svg, 3000),
+        (files.overlay_scad, 4000),
+        (str(source), 1000),
+    ]:
+        with open(path, "w") as f:
+            f.write("")
+        os.utime(path, (mtime, mtime))
+
+    # Every output is newer than its inputs, so nothing is regenerated
+    process_role("Imp", files)
+    mock_grey.assert_not_called()
+    mock_svg.assert_not_called()
+    mock_model.assert_not_called()
+
+    # Editing the code regenerates every step, not only the scad
+    os.utime(source, (5000, 5000))
+    process_role("Imp", files)
+    mock_grey.assert_called_once()
+    mock_svg.assert_called_once()
+    mock_model.assert_called_once()